@@ -4,35 +4,72 @@ FastAPI web application for Gmail Spam Killer.
 Provides a web UI to run spam detection and manage emails.
 """
 
-import json
+import logging
 import os
 import asyncio
-from typing import List, Optional
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List
+from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
+import orjson
 
 # Import our spam killer
-from gmail_spam_killer import GmailSpamKiller
+from gmail_spam_killer import GmailSpamKiller, configure_logging
 
-app = FastAPI(title="Gmail Spam Killer", description="AI-powered spam detection and management")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Gmail Spam Killer", description="AI-powered spam detection and management",
+              default_response_class=ORJSONResponse)
 
 # Templates
 templates = Jinja2Templates(directory="templates")
 
+# Number of scans kept in memory; the oldest finished scans are dropped first
+MAX_STORED_SCANS = 20
+# Seconds a scan stream waits for news before re-sending the status as a keepalive
+SCAN_STREAM_KEEPALIVE_SECONDS = 15
+
+@dataclass
+class ScanState:
+    scanning: bool = True
+    progress: int = 0
+    total: int = 0
+    current_email: str = 'Initializing...'
+    results: List[dict] = field(default_factory=list)
+    # Set, then replaced, on every change; each /api/scan/stream waits on it and keeps
+    # its own position in results, so any number of streams can follow one scan
+    changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    def progress_status(self):
+        """Return the scan status without the results list."""
+        return {
+            'scanning': self.scanning,
+            'progress': self.progress,
+            'total': self.total,
+            'current_email': self.current_email
+        }
+
+    def update(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self._notify()
+
+    def add_results(self, results):
+        self.results.extend(results)
+        self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
 # Global instance of spam killer
 spam_killer = None
-scan_status = {
-    'scanning': False,
-    'progress': 0,
-    'total': 0,
-    'current_email': '',
-    'results': []
-}
+# Scan states keyed by scan ID
+scans: Dict[str, ScanState] = {}
 
 # Pydantic models
 class ScanRequest(BaseModel):
@@ -59,6 +96,7 @@ class StatusResponse(BaseModel):
 class ScanResponse(BaseModel):
     success: bool
     message: str
+    scan_id: str = ''
     total_emails: int = 0
 
 class ArchiveResponse(BaseModel):
@@ -67,6 +105,29 @@ class ArchiveResponse(BaseModel):
     email_id: str
     unsubscribe_success: int = 0
 
+class BulkArchiveRequest(BaseModel):
+    email_ids: List[str]
+    unsubscribe: bool = False
+    unsubscribe_links: Dict[str, List[str]] = {}  # Keyed by email ID
+
+class BulkArchiveResponse(BaseModel):
+    success: bool
+    message: str
+    email_ids: List[str]
+    unsubscribe_success: int = 0
+
+@app.on_event("startup")
+async def startup():
+    """Load environment variables (e.g. OPENAI_API_KEY) from .env and set up logging."""
+    load_dotenv()
+    configure_logging()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the spam killer's verdict cache and HTTP connections."""
+    if spam_killer is not None:
+        await spam_killer.aclose()
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Main page."""
@@ -91,6 +152,8 @@ async def authenticate():
     """Initialize and authenticate spam killer."""
     global spam_killer
     try:
+        if spam_killer is not None:
+            await spam_killer.aclose()
         spam_killer = GmailSpamKiller()
         if spam_killer.authenticate_gmail():
             return {"success": True, "message": "Authenticated successfully"}
@@ -99,136 +162,165 @@ async def authenticate():
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+def get_scan(scan_id: str) -> ScanState:
+    """Look up a scan by ID."""
+    if scan_id not in scans:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    return scans[scan_id]
+
+def prune_scans():
+    """Drop the oldest finished scans once more than MAX_STORED_SCANS are stored."""
+    finished_ids = [scan_id for scan_id, state in scans.items() if not state.scanning]
+    for scan_id in finished_ids[:max(0, len(scans) - MAX_STORED_SCANS)]:
+        del scans[scan_id]
+
 @app.get("/api/scan/status")
-async def get_scan_status():
-    """Get current scan status."""
-    return scan_status
+async def get_scan_status(scan_id: str):
+    """Get the status of a scan."""
+    scan_status = get_scan(scan_id)
+    return {**scan_status.progress_status(), 'results': scan_status.results}
+
+def format_sse(event: str, data) -> str:
+    """Format a Server-Sent Event."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+@app.get("/api/scan/stream")
+async def stream_scan(scan_id: str):
+    """Stream scan progress and each result as it completes via Server-Sent Events."""
+    scan_status = get_scan(scan_id)
+    
+    async def event_stream():
+        sent = 0
+        while True:
+            # Grab the event before reading the state so a change made while we yield isn't missed
+            changed = scan_status.changed
+            for result in scan_status.results[sent:]:
+                yield format_sse('result', result)
+            sent = len(scan_status.results)
+            
+            if not scan_status.scanning:
+                yield format_sse('done', scan_status.progress_status())
+                return
+            yield format_sse('status', scan_status.progress_status())
+            
+            try:
+                await asyncio.wait_for(changed.wait(), SCAN_STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.post("/api/scan", response_model=ScanResponse)
 async def start_scan(scan_request: ScanRequest):
     """Start scanning emails for spam."""
-    global spam_killer, scan_status
+    global spam_killer
     
     if spam_killer is None or spam_killer.service is None:
         raise HTTPException(status_code=400, detail="Not authenticated. Please authenticate first.")
     
-    if scan_status['scanning']:
-        raise HTTPException(status_code=400, detail="Scan already in progress")
-    
-    # Reset scan status
-    scan_status.update({
-        'scanning': True,
-        'progress': 0,
-        'total': 0,
-        'current_email': 'Initializing...',
-        'results': []
-    })
+    # Create a fresh scan state
+    scan_id = uuid.uuid4().hex
+    scans[scan_id] = ScanState()
+    prune_scans()
     
     # Start background scan
-    asyncio.create_task(run_scan(scan_request.max_emails))
+    asyncio.create_task(run_scan(scan_id, scan_request.max_emails))
     
     return ScanResponse(
         success=True, 
         message="Scan started", 
+        scan_id=scan_id,
         total_emails=scan_request.max_emails
     )
 
-async def run_scan(max_emails: int):
+def build_email_results(classified):
+    """Turn (email, is_spam, reason) tuples into result dicts, finding unsubscribe links for spam.
+    
+    Makes blocking Gmail calls, so run it off the event loop.
+    """
+    # Fetch the HTML of all spam emails at once rather than one by one for unsubscribe links
+    spam_killer.fetch_email_html([email for email, is_spam, _ in classified if is_spam])
+    
+    email_results = []
+    for email, is_spam, reason in classified:
+        # Find unsubscribe links for spam emails
+        unsubscribe_links = []
+        if is_spam:
+            try:
+                unsubscribe_links = spam_killer.get_unsubscribe_links(email)
+            except Exception as e:
+                logger.error("Error finding unsubscribe links: %s", e)
+        
+        email_results.append(EmailResult(
+            email_id=email['id'],
+            subject=email['subject'][:80] + ('...' if len(email['subject']) > 80 else ''),
+            sender=email['sender'],
+            body_preview=email['body'][:200] + ('...' if len(email['body']) > 200 else ''),
+            is_spam=is_spam,
+            reason=reason,
+            unsubscribe_links=unsubscribe_links[:3]  # Limit to first 3
+        ).dict())
+    return email_results
+
+async def run_scan(scan_id: str, max_emails: int):
     """Run the email scan in background."""
-    global spam_killer, scan_status
+    global spam_killer
+    scan_status = scans[scan_id]
     
     try:
-        scan_status['current_email'] = f'Fetching up to {max_emails} emails...'
-        
-        # Fetch emails
-        emails = spam_killer.get_recent_emails(max_emails)
-        inbox_emails = [(i, email) for i, email in enumerate(emails) if 'INBOX' in email['labels']]
+        scan_status.update(current_email=f'Fetching up to {max_emails} emails...')
         
-        if not inbox_emails:
-            scan_status.update({
-                'scanning': False,
-                'current_email': 'No emails in inbox to process.'
-            })
-            return
+        # (email, is_spam, reason) per original email index, filled in as batches finish
+        results = {}
         
-        scan_status.update({
-            'total': len(inbox_emails),
-            'current_email': f'Analyzing {len(inbox_emails)} emails...'
-        })
+        async def publish_batch(batch_results, analyzed, total):
+            batch = [(email, is_spam_result, reason) for _, email, is_spam_result, reason in batch_results]
+            for index, email, is_spam_result, reason in batch_results:
+                results[index] = (email, is_spam_result, reason)
+            # Results go out as soon as their batch is classified, not when the whole scan is done
+            scan_status.add_results(await asyncio.to_thread(build_email_results, batch))
+            scan_status.update(progress=analyzed, total=total, current_email=f'Analyzed {analyzed}/{total} emails')
         
-        # Process emails in parallel
-        results = {}
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_index = {
-                executor.submit(spam_killer._analyze_email_batch, email_with_index): email_with_index[0]
-                for email_with_index in inbox_emails
-            }
-            
-            completed_count = 0
-            for future in as_completed(future_to_index):
-                completed_count += 1
-                scan_status.update({
-                    'progress': completed_count,
-                    'current_email': f'Analyzed {completed_count}/{len(inbox_emails)} emails'
-                })
-                
-                try:
-                    index, email, is_spam_result, reason = future.result()
-                    results[index] = {
-                        'email': email,
-                        'is_spam': is_spam_result,
-                        'reason': reason
-                    }
-                except Exception as e:
-                    print(f"Error processing email: {e}")
+        # Same pipeline as the CLI: each page is classified while the next one is fetched
+        emails, duplicate_emails, _ = await spam_killer.fetch_and_classify(max_emails, publish_batch)
         
-        # Process results in order
-        email_results = []
-        for i in sorted(results.keys()):
-            result = results[i]
-            email = result['email']
-            is_spam = result['is_spam']
-            reason = result['reason']
-            
-            # Find unsubscribe links for spam emails
-            unsubscribe_links = []
-            if is_spam:
-                try:
-                    raw_html = spam_killer.get_raw_email_html(email['id'])
-                    unsubscribe_links = spam_killer.find_unsubscribe_links(email['body'], raw_html)
-                except Exception as e:
-                    print(f"Error finding unsubscribe links: {e}")
-            
-            email_result = EmailResult(
-                email_id=email['id'],
-                subject=email['subject'][:80] + ('...' if len(email['subject']) > 80 else ''),
-                sender=email['sender'],
-                body_preview=email['body'][:200] + ('...' if len(email['body']) > 200 else ''),
-                is_spam=is_spam,
-                reason=reason,
-                unsubscribe_links=unsubscribe_links[:3]  # Limit to first 3
+        if not emails:
+            scan_status.update(
+                scanning=False,
+                current_email='No emails in inbox to process.'
             )
-            email_results.append(email_result.dict())
+            return
         
-        scan_status.update({
-            'scanning': False,
-            'current_email': 'Scan completed successfully!',
-            'results': email_results
-        })
+        # Duplicates share the verdict of the first email with their Message-ID
+        duplicates = []
+        for index, email, first_index in duplicate_emails:
+            if first_index in results:
+                first_email, is_spam_result, reason = results[first_index]
+                email['body'] = first_email['body']
+                email['html_data'] = first_email.get('html_data', [])
+                duplicates.append((email, is_spam_result, reason))
+        if duplicates:
+            scan_status.add_results(await asyncio.to_thread(build_email_results, duplicates))
+        
+        scan_status.update(
+            scanning=False,
+            current_email='Scan completed successfully!'
+        )
         
     except Exception as e:
-        scan_status.update({
-            'scanning': False,
-            'current_email': f'Error during scan: {str(e)}',
-            'results': []
-        })
+        scan_status.update(
+            scanning=False,
+            current_email=f'Error during scan: {str(e)}',
+            results=[]
+        )
 
 @app.get("/api/results")
-async def get_results():
+async def get_results(scan_id: str):
     """Get scan results."""
+    scan_status = get_scan(scan_id)
     return {
-        "results": scan_status['results'],
-        "total": len(scan_status['results'])
+        "results": scan_status.results,
+        "total": len(scan_status.results)
     }
 
 @app.post("/api/archive", response_model=ArchiveResponse)
@@ -243,10 +335,10 @@ async def archive_email(archive_request: ArchiveRequest):
         # Try to unsubscribe first if requested
         unsubscribe_success = 0
         if archive_request.unsubscribe and archive_request.unsubscribe_links:
-            unsubscribe_success = spam_killer.attempt_unsubscribe(archive_request.unsubscribe_links)
+            unsubscribe_success = await spam_killer.attempt_unsubscribe_async(archive_request.unsubscribe_links)
         
         # Archive the email
-        if spam_killer.archive_email(archive_request.email_id):
+        if await asyncio.to_thread(spam_killer.archive_email, archive_request.email_id):
             message = 'Email archived successfully!'
             if archive_request.unsubscribe and unsubscribe_success > 0:
                 message += f' Unsubscribed from {unsubscribe_success} mailing lists.'
@@ -273,6 +365,50 @@ async def archive_email(archive_request: ArchiveRequest):
             email_id=archive_request.email_id
         )
 
+@app.post("/api/archive/bulk", response_model=BulkArchiveResponse)
+async def archive_emails_bulk(archive_request: BulkArchiveRequest):
+    """Archive several spam emails in one Gmail request and optionally unsubscribe."""
+    global spam_killer
+    
+    if spam_killer is None:
+        raise HTTPException(status_code=400, detail="Not authenticated")
+    
+    try:
+        # Try to unsubscribe first if requested
+        unsubscribe_success = 0
+        if archive_request.unsubscribe:
+            unsubscribe_success = sum(await asyncio.gather(*[
+                spam_killer.attempt_unsubscribe_async(archive_request.unsubscribe_links[email_id])
+                for email_id in archive_request.email_ids
+                if archive_request.unsubscribe_links.get(email_id)
+            ]))
+        
+        # Archive the emails
+        if await asyncio.to_thread(spam_killer.archive_emails_bulk, archive_request.email_ids):
+            message = f'Successfully archived {len(archive_request.email_ids)} emails!'
+            if archive_request.unsubscribe and unsubscribe_success > 0:
+                message += f' Unsubscribed from {unsubscribe_success} mailing lists.'
+            
+            return BulkArchiveResponse(
+                success=True,
+                message=message,
+                email_ids=archive_request.email_ids,
+                unsubscribe_success=unsubscribe_success
+            )
+        else:
+            return BulkArchiveResponse(
+                success=False,
+                message=f'Failed to archive {len(archive_request.email_ids)} emails.',
+                email_ids=archive_request.email_ids
+            )
+            
+    except Exception as e:
+        return BulkArchiveResponse(
+            success=False,
+            message=f'Error: {str(e)}',
+            email_ids=archive_request.email_ids
+        )
+
 if __name__ == '__main__':
     import uvicorn
     
@@ -281,4 +417,7 @@ if __name__ == '__main__':
     
     print("🚀 Starting Gmail Spam Killer Web App...")
     print("🌐 Open your browser to http://localhost:8000")
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # uvicorn uses uvloop and httptools when installed (uvicorn[standard]).
+    # Auto-reload is only enabled for development (DEV=1). Scan state and
+    # authentication live in process memory, so this must run as a single worker.
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=bool(os.getenv('DEV')))
\ No newline at end of file
@@ -4,33 +4,43 @@ AI-powered Gmail spam filter that uses LLM to detect and archive spam emails.
 This is a defensive security tool to help protect against unwanted emails.
 """
 
-import base64
+import argparse
+import asyncio
+import atexit
+import binascii
+import concurrent.futures
+import functools
+import hashlib
+import html
 import json
+import logging
+import logging.handlers
+import math
 import os
-import pickle
+import queue
 import re
+import shelve
+import threading
 import time
 import warnings
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from pathlib import Path
-from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
-import requests
-
-# Suppress XML parsed as HTML warning
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-import openai
+from urllib.parse import urljoin
+
+import httpx
+import orjson
 from dotenv import load_dotenv
+from selectolax.lexbor import LexborHTMLParser
+
+try:
+    # SIMD base64 decoder; a large speedup for multi-hundred-KB HTML parts
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Google API, OpenAI and BeautifulSoup (with lxml) are imported where they are first
+# used to keep module import (and web app startup) fast
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 # Gmail API scopes
 SCOPES = [
@@ -40,34 +50,314 @@ SCOPES = [
 
 USER_DESCRIPTION = "A 28 year old designer who lives in SF and NYC. His interests include gambling, clothes, cars."
 
+# Sender domains (including subdomains) that are classified without calling the LLM
+TRUSTED_SENDER_DOMAINS = ['github.com', 'stripe.com']  # always NOT_SPAM
+BLOCKED_SENDER_DOMAINS = []  # always SPAM
+ALLOWLIST_PATH = 'allowlist.txt'  # Extra trusted sender domains, one per line; '#' starts a comment
+TRUST_PERSONAL_CATEGORY = True  # Treat emails Gmail files under Primary (CATEGORY_PERSONAL) as NOT_SPAM
+
 MAX_EMAILS = 100
 START_RANGE_DAYS = 14
 END_RANGE_DAYS = 0
-MAX_WORKERS = 20  # Number of parallel threads for OpenAI API calls
+MAX_WORKERS = 20  # Max concurrent OpenAI requests
+SPAM_BATCH_SIZE = 15  # Number of emails classified per OpenAI request
+BODY_CHAR_LIMIT = 1000  # Max email body characters sent to the LLM
+SNIPPET_MIN_CHARS = 80  # Fetch the full body when Gmail's snippet is shorter than this
+# Max tokens of each email field included in a prompt
+SUBJECT_TOKEN_LIMIT = 50
+SENDER_TOKEN_LIMIT = 30
+BODY_TOKEN_LIMIT = 400
+FALLBACK_CHARS_PER_TOKEN = 4  # Rough truncation ratio used when the tokenizer is unavailable
+TOKENIZER_RETRY_SECONDS = 300  # How long to truncate by characters after the tokenizer fails to load
+OPENAI_MODEL = "gpt-4o-mini"  # Default classification model; override with the SPAM_MODEL env var
+# Chat completion arguments shared by every classification request; only the model,
+# messages (and max_tokens for bulk requests) are added per call
+SPAM_COMPLETION_OPTIONS = {'max_tokens': 1, 'temperature': 0, 'logprobs': True}
+# Structured outputs guarantee bulk responses match this schema, so they always parse
+BULK_VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "spam": {"type": "boolean"},
+                    "reason": {"type": "string"}
+                },
+                "required": ["id", "spam", "reason"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+BULK_COMPLETION_OPTIONS = {
+    'temperature': 0.1,
+    'response_format': {
+        "type": "json_schema",
+        "json_schema": {"name": "spam_verdicts", "strict": True, "schema": BULK_VERDICT_SCHEMA}
+    }
+}
+BULK_TOKENS_PER_EMAIL = 60  # Output budget per email: an id, a boolean and a short reason
+VERDICT_CACHE_PATH = 'verdicts.db'  # On-disk cache of spam verdicts across runs
+VERDICT_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60  # Reclassify after this long, in case preferences changed
+SESSION_CACHE_PATH = 'session_cache.json'  # Label ID and spam examples reused across runs
+SESSION_CACHE_TTL_SECONDS = 24 * 60 * 60
+GMAIL_BATCH_SIZE = 50  # Max messages.get() calls per batch HTTP request (Gmail recommends <= 50)
+GMAIL_LIST_PAGE_SIZE = 500  # Max message IDs per messages.list() page
+GMAIL_BATCH_MODIFY_SIZE = 1000  # Max message IDs per messages.batchModify() call
+# Partial-response masks so messages.get() only returns the fields we read
+GMAIL_METADATA_FIELDS = 'id,labelIds,snippet,payload/headers'
+GMAIL_BODY_FIELDS = 'id,payload(mimeType,body/data,parts(mimeType,body/data,parts))'
+BATCH_API_POLL_SECONDS = 30  # How often to check on an OpenAI Batch API job
+# OpenAI rate limits to stay under; 429s that still happen are retried with backoff
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 200000
+OPENAI_MAX_RETRIES = 5
+# Semantic cache: reuse the verdict of a similar email from the same sender domain
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 256
+SEMANTIC_CACHE_THRESHOLD = 0.87  # Min cosine similarity to reuse a verdict
+SEMANTIC_CACHE_PREFIX = 'semantic:'  # Verdict cache key prefix for embedded entries
+MESSAGE_CACHE_PREFIX = 'message:'  # Verdict cache key prefix for Gmail message IDs, which never change
+# Sender reputation: a domain that has only ever sent spam is classified without the LLM
+SENDER_REPUTATION_PREFIX = 'sender:'  # Verdict cache key prefix for per-domain verdict counts
+SENDER_REPUTATION_MIN_SPAM = 3
+SENDER_REPUTATION_RECHECK_INTERVAL = 10  # Still send every Nth email from such a domain to the LLM
+FREEMAIL_DOMAINS = {'gmail.com', 'googlemail.com', 'outlook.com', 'hotmail.com', 'live.com',
+                    'yahoo.com', 'icloud.com', 'me.com', 'aol.com', 'proton.me', 'protonmail.com'}
+
+def configure_logging(level=logging.INFO):
+    """Route log records through a queue so writing them never blocks the caller.
+    
+    A QueueListener thread writes the records to stderr; the calling thread
+    (e.g. the web app's event loop) only enqueues them.
+    """
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+@functools.lru_cache(maxsize=None)
+def _get_beautiful_soup():
+    """Import BeautifulSoup once, on first use; it is only the fallback HTML parser."""
+    from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
+    
+    # Suppress XML parsed as HTML warning
+    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+    return BeautifulSoup
+
+@functools.lru_cache(maxsize=None)
+def _get_token_encoding(model=OPENAI_MODEL):
+    """Load the tokenizer for a model once, on first use."""
+    import tiktoken
+    
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+@functools.lru_cache(maxsize=None)
+def _verdict_tokens(model):
+    """Return the first token of "SPAM" and a logit_bias limiting output to it or the first token of "NOT_SPAM"."""
+    encoding = _get_token_encoding(model)
+    spam_token_id = encoding.encode("SPAM")[0]
+    not_spam_token_id = encoding.encode("NOT_SPAM")[0]
+    return encoding.decode([spam_token_id]), {str(spam_token_id): 100, str(not_spam_token_id): 100}
+
+# When the tokenizer can't be loaded, don't retry it before this time.monotonic() value
+_tokenizer_unavailable_until = 0.0
+
+def truncate_tokens(text, max_tokens):
+    """Truncate text to at most max_tokens tokens of the model's tokenizer.
+    
+    Falls back to a rough character limit if the tokenizer can't be loaded, e.g.
+    when tiktoken has no network access to download its encoding on first use.
+    """
+    global _tokenizer_unavailable_until
+    
+    # Byte-level BPE tokens cover at least one UTF-8 byte each, so text this short cannot exceed the limit
+    if len(text.encode('utf-8')) <= max_tokens:
+        return text
+    
+    if time.monotonic() >= _tokenizer_unavailable_until:
+        try:
+            encoding = _get_token_encoding()
+        except Exception as e:
+            logger.warning("Could not load the tokenizer, truncating by characters for now: %s", e)
+            _tokenizer_unavailable_until = time.monotonic() + TOKENIZER_RETRY_SECONDS
+        else:
+            tokens = encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            return encoding.decode(tokens[:max_tokens])
+    
+    return text[:max_tokens * FALLBACK_CHARS_PER_TOKEN]
+
+def get_date_range():
+    """Return the (start, end) dates for email scanning, computed at call time."""
+    start_date = (datetime.now() - timedelta(days=START_RANGE_DAYS)).strftime('%Y/%m/%d')  # futher back
+    end_date = (datetime.now() - timedelta(days=END_RANGE_DAYS)).strftime('%Y/%m/%d')  # more recent
+    return start_date, end_date
+
+def _compile_sender_domain_pattern(domains):
+    """Compile a regex matching sender addresses at any of the given domains."""
+    if not domains:
+        return None
+    alternation = '|'.join(re.escape(domain) for domain in domains)
+    return re.compile(rf'@(?:[\w-]+\.)*(?:{alternation})>?\s*$', re.IGNORECASE)
+
+BLOCKED_SENDER_PATTERN = _compile_sender_domain_pattern(BLOCKED_SENDER_DOMAINS)
+SENDER_DOMAIN_PATTERN = re.compile(r'@([\w.-]+)')
+
+def load_allowlist(path=ALLOWLIST_PATH):
+    """Read trusted sender domains from the allowlist file, or return [] if there is none."""
+    try:
+        with open(path) as f:
+            lines = [line.split('#', 1)[0].strip().lower() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line]
+
+# Unsubscribe link detection patterns
+UNSUBSCRIBE_URL_PATTERN = re.compile(r'https?://[^\s]+(?:unsubscribe|opt[_-]?out|remove|stop)[^\s]*', re.IGNORECASE)
+UNSUBSCRIBE_LINK_TEXT_PATTERN = re.compile(r'unsubscribe|opt out|remove|stop', re.IGNORECASE)
+UNSUBSCRIBE_HREF_PATTERN = re.compile(r'unsubscribe|opt-?out|remove', re.IGNORECASE)
+URL_TRAILING_CHARS_PATTERN = re.compile(r'[>)\].,;"\'\n]*$')
+LIST_UNSUBSCRIBE_URL_PATTERN = re.compile(r'<(https?://[^>]+)>')
+ONE_CLICK_UNSUBSCRIBE_PATTERN = re.compile(r'List-Unsubscribe\s*=\s*One-Click', re.IGNORECASE)
+
+# Per-email prompt around the subject, sender and body, joined rather than formatted per call
+SPAM_PROMPT_PREFIX = "Email to Analyze:\nSubject: "
+SPAM_PROMPT_SUFFIX = '\n\nBased on the above criteria and spam examples, respond with only "SPAM" or "NOT_SPAM".\n'
+
+# Maps the base64url alphabet onto standard base64 for the binascii fallback
+URLSAFE_BASE64_TRANSLATION = bytes.maketrans(b'-_', b'+/')
 
-# Date range for email scanning (modify these to change the time window)
-START_DATE = (datetime.now() - timedelta(days=START_RANGE_DAYS)).strftime('%Y/%m/%d')  # futher back
-END_DATE = (datetime.now() - timedelta(days=END_RANGE_DAYS)).strftime('%Y/%m/%d')  # more recent
+# Email body cleanup patterns
+URL_PATTERN = re.compile(r'https?://[^\s]+')
+ENCODED_CONTENT_PATTERN = re.compile(r'[a-zA-Z0-9+/]{50,}={0,2}')
+ELLIPSIS_PATTERN = re.compile(r'[.]{3,}')
+
+# HTTP clients shared by all OpenAI clients; HTTP/2 multiplexes concurrent
+# requests over pooled connections instead of a TLS handshake per request
+_HTTPX_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=50)
+_HTTPX_CLIENT = httpx.Client(http2=True, limits=_HTTPX_LIMITS, timeout=30.0)
+_ASYNC_HTTPX_CLIENT = httpx.AsyncClient(http2=True, limits=_HTTPX_LIMITS, timeout=30.0)
+
+def _new_unsubscribe_client():
+    """Create an HTTP/2 client for unsubscribe requests, which often go to the same few mailing list hosts."""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=10.0,
+        follow_redirects=True,
+        headers={
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        }
+    )
+
+class TokenBucketRateLimiter:
+    """Throttle async requests to stay under requests- and tokens-per-minute limits.
+    
+    Both buckets refill continuously; acquire() waits until there is capacity
+    for one request of the given token count instead of letting it hit a 429.
+    """
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed_minutes * self.max_requests)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed_minutes * self.max_tokens)
+    
+    async def acquire(self, tokens):
+        """Wait until one request using about `tokens` tokens can be sent."""
+        tokens = min(tokens, self.max_tokens)
+        while True:
+            self._refill()
+            # No await between the check and the update, so coroutines can't race here
+            if self.available_requests >= 1 and self.available_tokens >= tokens:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return
+            wait_minutes = max(
+                (1 - self.available_requests) / self.max_requests,
+                (tokens - self.available_tokens) / self.max_tokens
+            )
+            await asyncio.sleep(max(wait_minutes * 60, 0.01))
+    
+    def update_from_headers(self, headers):
+        """Lower the buckets to the capacity OpenAI reports is left in its x-ratelimit-* headers.
+        
+        The configured limits are only an estimate; other clients sharing the API
+        key draw on the same quota, so the server's count wins when it is lower.
+        """
+        self._refill()
+        try:
+            remaining_requests = headers.get('x-ratelimit-remaining-requests')
+            if remaining_requests is not None:
+                self.available_requests = min(self.available_requests, float(remaining_requests))
+            remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+            if remaining_tokens is not None:
+                self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+        except ValueError:
+            pass
 
 class GmailSpamKiller:
     def __init__(self):
+        import openai
+        
         self.service = None
+        self.credentials = None
         # Initialize OpenAI client with minimal parameters to avoid conflicts
-        import httpx
         self.openai_client = openai.OpenAI(
             api_key=os.getenv('OPENAI_API_KEY'),
-            http_client=httpx.Client()
+            http_client=_HTTPX_CLIENT,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+        self.async_openai_client = openai.AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=_ASYNC_HTTPX_CLIENT,
+            max_retries=OPENAI_MAX_RETRIES
         )
+        # Read at construction time so a value from .env (loaded in main()) applies
+        self.model = os.getenv('SPAM_MODEL', OPENAI_MODEL)
+        self.trusted_sender_pattern = _compile_sender_domain_pattern(TRUSTED_SENDER_DOMAINS + load_allowlist())
+        self.rate_limiter = TokenBucketRateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
+        self.verdict_cache = shelve.open(VERDICT_CACHE_PATH)
+        self.verdict_cache_lock = threading.Lock()
+        self.semantic_index = self._load_semantic_index()
         self.ai_archived_label_id = None
         self.spam_examples = []
-        self.spam_detection_prompt_template = None
-        self.unsubscribe_session = requests.Session()
-        self.unsubscribe_session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        })
+        self.spam_detection_instructions = None
+        self.spam_detection_system_message = None
+        # Created on first use by attempt_unsubscribe_async; the CLI uses a client per call instead
+        self.unsubscribe_client = None
+        # Header URLs whose sender supports RFC 8058 one-click unsubscribe
+        self.one_click_unsubscribe_urls = set()
         
     def authenticate_gmail(self):
         """Authenticate with Gmail API using OAuth2."""
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build
+        
         creds = None
         
         # Token file stores user's access and refresh tokens
@@ -80,9 +370,8 @@ class GmailSpamKiller:
                 creds.refresh(Request())
             else:
                 if not os.path.exists('credentials.json'):
-                    print("Error: credentials.json file not found!")
-                    print("Please download OAuth2 credentials from Google Cloud Console")
-                    print("and save as 'credentials.json' in the project directory.")
+                    logger.error("credentials.json file not found! Please download OAuth2 credentials "
+                                 "from Google Cloud Console and save as 'credentials.json' in the project directory.")
                     return False
                     
                 flow = InstalledAppFlow.from_client_secrets_file(
@@ -93,110 +382,289 @@ class GmailSpamKiller:
             with open('token.json', 'w') as token:
                 token.write(creds.to_json())
                 
+        self.credentials = creds
         self.service = build('gmail', 'v1', credentials=creds)
-        self._ensure_ai_archived_label()
-        self._collect_spam_examples()
+        if not self._load_session_cache():
+            self._ensure_ai_archived_label()
+            self._collect_spam_examples()
+            self._save_session_cache()
         return True
+    
+    def _load_session_cache(self):
+        """Restore the label ID and spam examples saved by a recent run, returning True on success."""
+        try:
+            with open(SESSION_CACHE_PATH) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        try:
+            if time.time() - cached.get('ts', 0) > SESSION_CACHE_TTL_SECONDS:
+                return False
+            label_id = cached['label_id']
+            spam_examples = cached['spam_examples']
+        except (AttributeError, KeyError, TypeError) as e:
+            logger.warning("Ignoring malformed %s: %s", SESSION_CACHE_PATH, e)
+            return False
+        
+        self.ai_archived_label_id = label_id
+        self.spam_examples = spam_examples
+        self._build_spam_detection_prompt()
+        logger.info("Loaded 'AI Archived' label and %d spam examples from %s", len(self.spam_examples), SESSION_CACHE_PATH)
+        return True
+    
+    def _save_session_cache(self):
+        """Save the label ID and spam examples so the next run can skip fetching them."""
+        # Don't keep a failed lookup around for a whole day
+        if not self.ai_archived_label_id or not self.spam_examples:
+            return
+        
+        try:
+            with open(SESSION_CACHE_PATH, 'w') as f:
+                json.dump({
+                    'label_id': self.ai_archived_label_id,
+                    'spam_examples': self.spam_examples,
+                    'ts': time.time()
+                }, f)
+        except OSError as e:
+            logger.warning("Could not save %s: %s", SESSION_CACHE_PATH, e)
         
     def get_recent_emails(self, max_results=MAX_EMAILS):
         """Fetch emails from inbox within the specified date range."""
+        return [email for page in self.iter_recent_emails(max_results) for email in page]
+    
+    def iter_recent_emails(self, max_results=MAX_EMAILS):
+        """Yield inbox emails within the date range, one Gmail batch request's worth at a time.
+        
+        Callers can start processing a page while the next one is still being fetched.
+        """
         try:
             # Build query with date range
-            query = f'in:inbox after:{START_DATE} before:{END_DATE}'
+            start_date, end_date = get_date_range()
+            query = f'after:{start_date} before:{end_date}'
             
-            # Get list of messages
-            results = self.service.users().messages().list(
-                userId='me', 
-                q=query,
-                maxResults=max_results
-            ).execute()
-            
-            messages = results.get('messages', [])
-            emails = []
+            http = self._thread_safe_http()
+            remaining = max_results
+            page_token = None
             
-            for message in messages:
-                # Get full message details
-                msg = self.service.users().messages().get(
+            while remaining > 0:
+                # Get a page of inbox messages (filtered server-side); the next page is
+                # only requested once the caller has consumed this one
+                results = self.service.users().messages().list(
                     userId='me', 
-                    id=message['id'],
-                    format='full'
-                ).execute()
+                    q=query,
+                    labelIds=['INBOX'],
+                    maxResults=min(remaining, GMAIL_LIST_PAGE_SIZE),
+                    pageToken=page_token
+                ).execute(http=http)
                 
-                # Extract headers
-                headers = msg['payload'].get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
+                messages = results.get('messages', [])
+                remaining -= len(messages)
                 
-                # Extract body
-                body = self.extract_email_body(msg['payload'])
+                # Get message headers and snippets in batched round trips; full bodies are
+                # fetched later with fetch_email_bodies() only where the snippet is too short
+                message_ids = [message['id'] for message in messages]
+                pages = self._iter_batch_get_messages(message_ids, format='metadata', fields=GMAIL_METADATA_FIELDS,
+                                                      metadataHeaders=['Subject', 'From', 'Message-ID',
+                                                                       'List-Unsubscribe', 'List-Unsubscribe-Post'])
+                for page in pages:
+                    emails = []
+                    for msg in page:
+                        # Extract headers
+                        headers = self._header_dict(msg['payload'])
+                        subject = headers.get('subject', 'No Subject')
+                        sender = headers.get('from', 'Unknown Sender')
+                        message_id = headers.get('message-id', '')
+                        list_unsubscribe = headers.get('list-unsubscribe', '')
+                        list_unsubscribe_post = headers.get('list-unsubscribe-post', '')
+                        
+                        emails.append({
+                            'id': msg['id'],
+                            'subject': subject,
+                            'sender': sender,
+                            'body': html.unescape(msg.get('snippet', '')),
+                            'message_id': message_id,
+                            'list_unsubscribe': list_unsubscribe,
+                            'list_unsubscribe_post': list_unsubscribe_post,
+                            'labels': msg.get('labelIds', [])
+                        })
+                    yield emails
                 
-                emails.append({
-                    'id': message['id'],
-                    'subject': subject,
-                    'sender': sender,
-                    'body': body[:1000],  # Limit body length for API efficiency
-                    'labels': msg.get('labelIds', [])
-                })
+                page_token = results.get('nextPageToken')
+                if not page_token or not messages:
+                    break
+            
+        except Exception as error:
+            logger.error('An error occurred: %s', error)
+    
+    def _header_dict(self, payload):
+        """Map lowercased header names to values, keeping the first occurrence of each."""
+        return {h['name'].lower(): h['value'] for h in reversed(payload.get('headers', []))}
+    
+    def deduplicate_emails(self, emails_with_index, first_index_by_message_id=None):
+        """Split (index, email) pairs into unique emails and repeats of an earlier Message-ID.
+        
+        Returns (unique_emails, duplicates) where each duplicate is
+        (index, email, index of the first email with the same Message-ID).
+        Pass the same first_index_by_message_id dict to deduplicate across calls.
+        """
+        unique_emails = []
+        duplicates = []
+        if first_index_by_message_id is None:
+            first_index_by_message_id = {}
+        
+        for index, email in emails_with_index:
+            message_id = email.get('message_id')
+            if message_id in first_index_by_message_id:
+                duplicates.append((index, email, first_index_by_message_id[message_id]))
+                continue
+            if message_id:
+                first_index_by_message_id[message_id] = index
+            unique_emails.append((index, email))
+            
+        return unique_emails, duplicates
+    
+    def fetch_email_bodies(self, emails):
+        """Replace too-short snippets with the full body, using a batched format='full' fetch."""
+        try:
+            # Messages classified on an earlier run keep their verdict, so skip their bodies too
+            emails_to_fetch = [
+                email for email in emails
+                if len(email['body']) < SNIPPET_MIN_CHARS and self._get_cached_message_verdict(email) is None
+            ]
+            emails_by_id = {email['id']: email for email in emails_to_fetch}
+            
+            def apply_bodies(messages):
+                for msg in messages:
+                    email = emails_by_id[msg['id']]
+                    # Limit body length for API efficiency
+                    email['body'] = self.extract_email_body(msg['payload'])[:BODY_CHAR_LIMIT]
+                    # Keep the still-encoded HTML so unsubscribe links can be found without refetching
+                    email['html_data'] = list(self._iter_part_data(msg['payload'], 'text/html'))
+            
+            # Parse each batch in a worker while the next batch is on the wire; the fetch
+            # waits on the network without holding the GIL, so the two overlap
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                futures = [
+                    executor.submit(apply_bodies, page)
+                    for page in self._iter_batch_get_messages(list(emails_by_id), fields=GMAIL_BODY_FIELDS)
+                ]
+            for future in futures:
+                future.result()
                 
             return emails
             
         except Exception as error:
-            print(f'An error occurred: {error}')
-            return []
-            
-    def extract_email_body(self, payload):
-        """Extract clean, readable text content from email payload."""
-        def decode_base64_data(data):
-            """Safely decode base64 email data."""
-            try:
-                return base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-            except Exception:
-                return ""
+            logger.error('Error fetching email bodies: %s', error)
+            return emails
+    
+    def fetch_email_html(self, emails):
+        """Fetch the HTML parts that unsubscribe link lookups will need, in batched round trips.
         
-        def extract_text_from_parts(parts):
-            """Recursively extract text from email parts."""
-            text_content = ""
-            html_content = ""
+        Skips emails that already have their HTML or whose List-Unsubscribe header names URLs.
+        """
+        try:
+            emails_to_fetch = [
+                email for email in emails
+                if 'html_data' not in email
+                and not LIST_UNSUBSCRIBE_URL_PATTERN.search(email.get('list_unsubscribe', ''))
+            ]
+            messages = self._batch_get_messages([email['id'] for email in emails_to_fetch], fields=GMAIL_BODY_FIELDS)
+            payloads = {msg['id']: msg['payload'] for msg in messages}
             
-            for part in parts:
-                mime_type = part.get('mimeType', '')
-                
-                # Handle nested parts (multipart)
-                if 'parts' in part:
-                    nested_text, nested_html = extract_text_from_parts(part['parts'])
-                    text_content += nested_text
-                    html_content += nested_html
-                
-                # Extract text/plain
-                elif mime_type == 'text/plain' and 'data' in part.get('body', {}):
-                    decoded = decode_base64_data(part['body']['data'])
-                    text_content += decoded + "\n"
-                
-                # Extract text/html
-                elif mime_type == 'text/html' and 'data' in part.get('body', {}):
-                    decoded = decode_base64_data(part['body']['data'])
-                    html_content += decoded + "\n"
+            for email in emails_to_fetch:
+                if email['id'] in payloads:
+                    email['html_data'] = list(self._iter_part_data(payloads[email['id']], 'text/html'))
             
-            return text_content, html_content
+            return emails
+            
+        except Exception as error:
+            logger.error('Error fetching email HTML: %s', error)
+            return emails
+    
+    def _thread_safe_http(self):
+        """Create a new authorized HTTP object, since httplib2 is not thread-safe."""
+        import google_auth_httplib2
+        import httplib2
+        
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+    
+    def _batch_get_messages(self, message_ids, format='full', **get_kwargs):
+        """Fetch messages using batch HTTP requests, returned in the order of message_ids."""
+        return [msg for page in self._iter_batch_get_messages(message_ids, format, **get_kwargs) for msg in page]
+    
+    def _iter_batch_get_messages(self, message_ids, format='full', **get_kwargs):
+        """Yield the messages fetched by each batch HTTP request, in the order of message_ids."""
+        responses = {}
+        http = self._thread_safe_http()
+        
+        def collect_response(request_id, response, exception):
+            """Store each batch response keyed by message ID."""
+            if exception is not None:
+                logger.error("Error fetching message %s: %s", request_id, exception)
+                return
+            responses[request_id] = response
         
+        for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+            batch_ids = message_ids[start:start + GMAIL_BATCH_SIZE]
+            batch = self.service.new_batch_http_request(callback=collect_response)
+            for message_id in batch_ids:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        format=format,
+                        **get_kwargs
+                    ),
+                    request_id=message_id
+                )
+            batch.execute(http=http)
+            yield [responses[message_id] for message_id in batch_ids if message_id in responses]
+            
+    def _decode_base64_data(self, data):
+        """Safely decode base64url email data, with or without padding."""
+        try:
+            # Extra padding is ignored, so always appending it handles unpadded data too
+            if pybase64 is not None:
+                raw = pybase64.b64decode(data + '==', altchars=b'-_')
+            else:
+                raw = binascii.a2b_base64(data.encode('ascii').translate(URLSAFE_BASE64_TRANSLATION) + b'==')
+            return raw.decode('utf-8', errors='ignore')
+        except (ValueError, TypeError, AttributeError):
+            return ""
+    
+    def _iter_part_data(self, part, mime_type):
+        """Yield the base64 data of (sub)parts with the given MIME type, in document order."""
+        # Walk nested multipart trees with an explicit stack rather than recursion
+        stack = [part]
+        while stack:
+            part = stack.pop()
+            if 'parts' in part:
+                stack.extend(reversed(part['parts']))
+            elif part.get('mimeType') == mime_type and 'data' in part.get('body', {}):
+                yield part['body']['data']
+    
+    def extract_email_body(self, payload):
+        """Extract clean, readable text content from email payload."""
         def clean_html_to_text(html_content):
             """Convert HTML to clean readable text."""
             try:
-                soup = BeautifulSoup(html_content, 'lxml')
+                tree = LexborHTMLParser(html_content)
                 
                 # Remove script and style elements
-                for script in soup(["script", "style", "meta", "link"]):
-                    script.decompose()
-                
-                # Get text and clean it up
-                text = soup.get_text()
+                tree.strip_tags(["script", "style", "meta", "link"])
                 
-                # Clean up whitespace
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                text = ' '.join(chunk for chunk in chunks if chunk)
-                
-                return text
+                # Whitespace is normalized by clean_text
+                return tree.body.text(separator=' ', strip=True) if tree.body else ""
+            except Exception:
+                pass
+            
+            # Fall back to BeautifulSoup if the fast parser fails
+            try:
+                soup = _get_beautiful_soup()(html_content, 'lxml')
+                for element in soup(["script", "style", "meta", "link"]):
+                    element.decompose()
+                return soup.get_text(' ')
             except Exception:
                 return html_content  # Fallback to raw HTML if parsing fails
         
@@ -205,44 +673,37 @@ class GmailSpamKiller:
             if not text:
                 return ""
             
-            # Remove excessive whitespace
-            text = re.sub(r'\s+', ' ', text)
+            # Collapse whitespace runs and trim the ends in one pass
+            text = ' '.join(text.split())
             
             # Remove URLs that are just noise
-            text = re.sub(r'https?://[^\s]+', '[URL]', text)
+            text = URL_PATTERN.sub('[URL]', text)
             
             # Remove email tracking pixels and long encoded strings
-            text = re.sub(r'[a-zA-Z0-9+/]{50,}={0,2}', '[ENCODED_CONTENT]', text)
+            text = ENCODED_CONTENT_PATTERN.sub('[ENCODED_CONTENT]', text)
             
             # Remove excessive punctuation
-            text = re.sub(r'[.]{3,}', '...', text)
+            text = ELLIPSIS_PATTERN.sub('...', text)
             
-            return text.strip()
+            return text
         
-        # Start extraction
-        text_body = ""
-        html_body = ""
+        # Prefer plain text, decoding parts only until there is enough for the body limit
+        text_chunks = []
+        text_length = 0
+        for data in self._iter_part_data(payload, 'text/plain'):
+            decoded = self._decode_base64_data(data)
+            text_chunks.append(decoded)
+            text_length += len(decoded) + 1
+            if text_length >= BODY_CHAR_LIMIT:
+                break
+        text_body = '\n'.join(text_chunks)
         
-        if 'parts' in payload:
-            # Multipart email
-            text_body, html_body = extract_text_from_parts(payload['parts'])
-        else:
-            # Single part email
-            mime_type = payload.get('mimeType', '')
-            if 'data' in payload.get('body', {}):
-                decoded = decode_base64_data(payload['body']['data'])
-                if mime_type == 'text/plain':
-                    text_body = decoded
-                elif mime_type == 'text/html':
-                    html_body = decoded
-        
-        # Prefer plain text, but convert HTML if that's all we have
         if text_body:
             final_text = clean_text(text_body)
-        elif html_body:
-            final_text = clean_text(clean_html_to_text(html_body))
         else:
-            final_text = ""
+            # Only decode and parse HTML if that's all we have
+            html_data = next(self._iter_part_data(payload, 'text/html'), None)
+            final_text = clean_text(clean_html_to_text(self._decode_base64_data(html_data))) if html_data else ""
         
         # If we still don't have good content, try to extract from subject/headers
         if not final_text or len(final_text) < 20:
@@ -250,148 +711,614 @@ class GmailSpamKiller:
         
         return final_text
         
+    def close(self):
+        """Release resources held by the spam killer."""
+        with self.verdict_cache_lock:
+            self.verdict_cache.close()
+    
+    async def aclose(self):
+        """Release resources held by the spam killer, including its pooled unsubscribe connections."""
+        if self.unsubscribe_client is not None:
+            await self.unsubscribe_client.aclose()
+            self.unsubscribe_client = None
+        self.close()
+    
+    def _verdict_cache_key(self, email):
+        """Hash the parts of an email that determine its verdict."""
+        content = f"{email['sender']}|{email['subject']}|{email['body'][:500]}"
+        return hashlib.sha256(content.encode()).hexdigest()
+    
+    def _sender_list_verdict(self, email):
+        """Return the verdict for a sender on the trusted or blocked list, or None."""
+        sender = email['sender']
+        if self.trusted_sender_pattern and self.trusted_sender_pattern.search(sender):
+            return False, "NOT_SPAM - Sender is on the trusted list"
+        if BLOCKED_SENDER_PATTERN and BLOCKED_SENDER_PATTERN.search(sender):
+            return True, "SPAM - Sender is on the blocked list"
+        return None
+    
+    def _cheap_classify(self, email):
+        """Classify obvious ham/spam from the sender's history and Gmail's labels, or return None if unsure.
+        
+        Counts the email towards its domain's reputation rechecks, so call it once per email.
+        """
+        reputation = self._sender_reputation(email)
+        if reputation and not reputation['not_spam'] and reputation['spam'] >= SENDER_REPUTATION_MIN_SPAM:
+            # Let an occasional email through so a domain blocked by early misclassifications can recover
+            if self._record_reputation_skip(email) % SENDER_REPUTATION_RECHECK_INTERVAL:
+                return True, f"SPAM - All {reputation['spam']} earlier emails from this domain were spam"
+        
+        # Gmail's category only applies once the sender's history is silent
+        if TRUST_PERSONAL_CATEGORY and 'CATEGORY_PERSONAL' in email.get('labels', ()):
+            return False, "NOT_SPAM - Gmail filed it under Primary"
+        return None
+    
+    def _sender_reputation(self, email):
+        """Return the spam/not_spam verdict counts for the sender's domain, or None."""
+        domain = self._sender_domain(email)
+        # Shared mail providers say nothing about an individual sender
+        if domain in FREEMAIL_DOMAINS:
+            return None
+        with self.verdict_cache_lock:
+            reputation = self.verdict_cache.get(SENDER_REPUTATION_PREFIX + domain)
+        # Counts go stale like verdicts do; ones written before last_seen existed count as stale
+        if reputation is None or self._is_expired(reputation.get('last_seen', 0)):
+            return None
+        return reputation
+    
+    def _record_reputation_skip(self, email):
+        """Count an email classified by its sender's reputation alone, returning the new count."""
+        key = SENDER_REPUTATION_PREFIX + self._sender_domain(email)
+        with self.verdict_cache_lock:
+            reputation = self.verdict_cache[key]
+            reputation['skipped'] = reputation.get('skipped', 0) + 1
+            self.verdict_cache[key] = reputation
+        return reputation['skipped']
+    
+    def _known_verdict(self, email):
+        """Return a verdict available without calling the LLM, or None.
+        
+        The user's sender lists come first, then this email's own cached verdict,
+        so rescans don't use up a blocked domain's reputation recheck.
+        """
+        verdict = self._sender_list_verdict(email)
+        if verdict is None:
+            verdict = self._get_cached_verdict(email)
+        if verdict is None:
+            verdict = self._cheap_classify(email)
+        return verdict
+    
+    def _load_semantic_index(self):
+        """Group the unexpired embedded verdicts in the verdict cache by sender domain.
+        
+        Expired entries, untimestamped ones from older versions and ones from
+        shared mail providers (indexed by older versions) are deleted.
+        """
+        semantic_index = {}
+        expired_keys = []
+        for key in self.verdict_cache.keys():
+            if key.startswith(SEMANTIC_CACHE_PREFIX):
+                domain, embedding, verdict, *cached_at = self.verdict_cache[key]
+                if not cached_at or self._is_expired(cached_at[0]) or domain in FREEMAIL_DOMAINS:
+                    expired_keys.append(key)
+                    continue
+                semantic_index.setdefault(domain, []).append((embedding, verdict, cached_at[0]))
+        for key in expired_keys:
+            del self.verdict_cache[key]
+        return semantic_index
+    
+    def _sender_domain(self, email):
+        """Return the lowercased domain of an email's sender."""
+        match = SENDER_DOMAIN_PATTERN.search(email['sender'])
+        return (match.group(1) if match else email['sender']).lower()
+    
+    def _embedding_kwargs(self, emails):
+        """Build the embeddings.create() arguments for the semantic cache."""
+        return {
+            'model': EMBEDDING_MODEL,
+            'dimensions': EMBEDDING_DIMENSIONS,
+            'input': [f"{email['subject']}\n{email['body'][:500]}" for email in emails],
+        }
+    
+    def _similar_verdicts(self, emails, response):
+        """Look up each embedded email in the semantic cache, returning a verdict or None.
+        
+        Misses keep their normalized embedding so _cache_verdict can index it.
+        """
+        verdicts = []
+        for email, item in zip(emails, response.data):
+            norm = math.sqrt(sum(value * value for value in item.embedding)) or 1.0
+            embedding = [value / norm for value in item.embedding]
+            
+            best_similarity, best_verdict = 0.0, None
+            with self.verdict_cache_lock:
+                neighbours = list(self.semantic_index.get(self._sender_domain(email), []))
+            for cached_embedding, verdict, cached_at in neighbours:
+                # A long-running web app can outlive entries that were fresh at startup
+                if self._is_expired(cached_at):
+                    continue
+                similarity = sum(a * b for a, b in zip(embedding, cached_embedding))
+                if similarity > best_similarity:
+                    best_similarity, best_verdict = similarity, verdict
+            if best_similarity >= SEMANTIC_CACHE_THRESHOLD:
+                verdicts.append(best_verdict)
+            else:
+                email['embedding'] = embedding
+                verdicts.append(None)
+        return verdicts
+    
+    def _semantic_candidates(self, emails, verdicts):
+        """Return the indices of emails with no verdict yet that the semantic cache can match."""
+        # Shared mail providers say nothing about an individual sender, so their
+        # emails have no meaningful neighbours and are not embedded
+        return [
+            i for i, (email, verdict) in enumerate(zip(emails, verdicts))
+            if verdict is None and self._sender_domain(email) not in FREEMAIL_DOMAINS
+        ]
+    
+    def _lookup_verdicts(self, emails):
+        """Return known verdicts for emails, consulting the semantic cache for the rest."""
+        verdicts = [self._known_verdict(email) for email in emails]
+        miss_indices = self._semantic_candidates(emails, verdicts)
+        if miss_indices:
+            misses = [emails[i] for i in miss_indices]
+            try:
+                response = self.openai_client.embeddings.create(**self._embedding_kwargs(misses))
+                for i, verdict in zip(miss_indices, self._similar_verdicts(misses, response)):
+                    verdicts[i] = verdict
+            except Exception as e:
+                logger.error("Error embedding emails: %s", e)
+        return verdicts
+    
+    async def _lookup_verdicts_async(self, emails):
+        """Async version of _lookup_verdicts using the AsyncOpenAI client."""
+        verdicts = [self._known_verdict(email) for email in emails]
+        miss_indices = self._semantic_candidates(emails, verdicts)
+        if miss_indices:
+            misses = [emails[i] for i in miss_indices]
+            try:
+                response = await self.async_openai_client.embeddings.create(**self._embedding_kwargs(misses))
+                for i, verdict in zip(miss_indices, self._similar_verdicts(misses, response)):
+                    verdicts[i] = verdict
+            except Exception as e:
+                logger.error("Error embedding emails: %s", e)
+        return verdicts
+    
+    def _get_cached_verdict(self, email):
+        """Return the cached (is_spam, reason) verdict for an email, or None."""
+        verdict = self._get_cached_message_verdict(email)
+        if verdict is None:
+            verdict = self._read_cached_verdict(self._verdict_cache_key(email))
+        return verdict
+    
+    def _get_cached_message_verdict(self, email):
+        """Return the verdict cached for this Gmail message ID, or None."""
+        if 'id' not in email:
+            return None
+        return self._read_cached_verdict(MESSAGE_CACHE_PREFIX + email['id'])
+    
+    def _read_cached_verdict(self, key):
+        """Return the (is_spam, reason) verdict stored under key, or None if missing or expired."""
+        with self.verdict_cache_lock:
+            entry = self.verdict_cache.get(key)
+        if entry is None:
+            return None
+        
+        # Untimestamped entries from older versions count as expired, like semantic entries
+        is_spam_result, reason, *cached_at = entry
+        if not cached_at or self._is_expired(cached_at[0]):
+            return None
+        return is_spam_result, reason
+    
+    def _is_expired(self, cached_at):
+        """Return whether something cached at the given time is older than the verdict TTL."""
+        return time.time() - cached_at > VERDICT_CACHE_TTL_SECONDS
+    
+    def _cache_verdict(self, email, verdict):
+        """Store an (is_spam, reason) verdict for an email."""
+        embedding = email.pop('embedding', None)
+        now = time.time()
+        timestamped_verdict = (*verdict, now)
+        with self.verdict_cache_lock:
+            key = self._verdict_cache_key(email)
+            self.verdict_cache[key] = timestamped_verdict
+            if 'id' in email:
+                self.verdict_cache[MESSAGE_CACHE_PREFIX + email['id']] = timestamped_verdict
+            domain = self._sender_domain(email)
+            if embedding is not None and domain not in FREEMAIL_DOMAINS:
+                self.verdict_cache[SEMANTIC_CACHE_PREFIX + key] = (domain, embedding, verdict, now)
+                self.semantic_index.setdefault(domain, []).append((embedding, verdict, now))
+            
+            if domain not in FREEMAIL_DOMAINS:
+                reputation = self.verdict_cache.get(SENDER_REPUTATION_PREFIX + domain)
+                if reputation is None or self._is_expired(reputation.get('last_seen', 0)):
+                    reputation = {'spam': 0, 'not_spam': 0}
+                reputation['spam' if verdict[0] else 'not_spam'] += 1
+                reputation['last_seen'] = now
+                self.verdict_cache[SENDER_REPUTATION_PREFIX + domain] = reputation
+    
+    def _estimate_tokens(self, completion_kwargs):
+        """Roughly estimate the tokens a chat completion request counts against the rate limit."""
+        prompt_chars = sum(len(message['content']) for message in completion_kwargs['messages'])
+        return prompt_chars // 4 + completion_kwargs.get('max_tokens', 0)
+    
+    def _prompt_fields(self, email):
+        """Return the subject, sender and body of an email truncated to their token budgets."""
+        return {
+            'subject': truncate_tokens(email['subject'], SUBJECT_TOKEN_LIMIT),
+            'sender': truncate_tokens(email['sender'], SENDER_TOKEN_LIMIT),
+            'body': truncate_tokens(email['body'], BODY_TOKEN_LIMIT)
+        }
+    
+    def _classification_messages(self, prompt):
+        """Put the per-email prompt after the shared instructions.
+        
+        The instructions and spam examples are identical for every request, so
+        sending them as a separate leading system message lets OpenAI's prompt
+        caching reuse them.
+        """
+        return [self.spam_detection_system_message, {"role": "user", "content": prompt}]
+    
+    def _spam_completion_kwargs(self, email):
+        """Build the chat completion arguments for classifying an email."""
+        # Splice the email details between the static prompt pieces
+        fields = self._prompt_fields(email)
+        prompt = ''.join([
+            SPAM_PROMPT_PREFIX, fields['subject'],
+            "\nFrom: ", fields['sender'],
+            "\nBody: ", fields['body'],
+            SPAM_PROMPT_SUFFIX
+        ])
+        
+        # A single output token, forced to the start of SPAM or NOT_SPAM, is enough to tell them apart
+        _, logit_bias = _verdict_tokens(self.model)
+        return {
+            **SPAM_COMPLETION_OPTIONS,
+            'model': self.model,
+            'messages': self._classification_messages(prompt),
+            'logit_bias': logit_bias
+        }
+    
+    async def _create_completion_async(self, completion_kwargs):
+        """Send a chat completion once the rate limiter allows it, then sync the limiter with OpenAI's count."""
+        await self.rate_limiter.acquire(self._estimate_tokens(completion_kwargs))
+        raw_response = await self.async_openai_client.chat.completions.with_raw_response.create(**completion_kwargs)
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        self._log_prompt_cache_usage(response)
+        return response
+    
+    def _log_prompt_cache_usage(self, response):
+        """Log how much of a request's prompt was served from OpenAI's prompt cache."""
+        usage = response.usage
+        details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+        if details is not None:
+            logger.debug("Prompt tokens: %d, cached: %d", usage.prompt_tokens, details.cached_tokens or 0)
+    
+    def _parse_single_response(self, response):
+        """Turn a one-token classification into an (is_spam, reason) verdict."""
+        top_token = response.choices[0].logprobs.content[0]
+        spam_token, _ = _verdict_tokens(self.model)
+        is_spam_result = top_token.token.strip() == spam_token.strip()
+        label = "SPAM" if is_spam_result else "NOT_SPAM"
+        return is_spam_result, f"{label} - {math.exp(top_token.logprob):.0%} confidence"
+    
+    def _bulk_completion_kwargs(self, emails):
+        """Build the chat completion arguments for classifying several emails in one request."""
+        email_blocks = "".join(
+            "\nEmail {i}:\nSubject: {subject}\nFrom: {sender}\nBody: {body}\n".format(i=i, **self._prompt_fields(email))
+            for i, email in enumerate(emails, 1)
+        )
+        prompt = f"""Emails to Analyze:
+{email_blocks}
+Based on the above criteria and spam examples, classify each email. For each one, give its email number as "id", whether it is spam, and a brief reason of a few words.
+"""
+        
+        return {
+            **BULK_COMPLETION_OPTIONS,
+            'model': self.model,
+            'messages': self._classification_messages(prompt),
+            'max_tokens': BULK_TOKENS_PER_EMAIL * len(emails)
+        }
+    
+    def _parse_bulk_response(self, content, emails):
+        """Parse a bulk classification into (is_spam, reason) tuples, or None if malformed."""
+        try:
+            verdicts = {int(item['id']): item for item in orjson.loads(content)['results']}
+            results = []
+            for i in range(1, len(emails) + 1):
+                is_spam_result = verdicts[i]['spam'] is True
+                label = "SPAM" if is_spam_result else "NOT_SPAM"
+                results.append((is_spam_result, f"{label} - {verdicts[i].get('reason', '')}"))
+            return results
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Malformed bulk classification response: %s", e)
+            return None
+    
     def is_spam(self, email):
         """Use LLM to determine if email is spam."""
-        # Use the pre-built prompt template and fill in the email details
-        prompt = self.spam_detection_prompt_template.format(
-            subject=email['subject'],
-            sender=email['sender'],
-            body=email['body']
-        )
+        known_verdict = self._known_verdict(email)
+        if known_verdict is not None:
+            return known_verdict
+        return self._classify_with_llm(email)
+    
+    def _classify_with_llm(self, email):
+        """Classify one email with the LLM, skipping the known-verdict lookup the caller already did."""
+        try:
+            response = self.openai_client.chat.completions.create(**self._spam_completion_kwargs(email))
+            self._log_prompt_cache_usage(response)
+            
+            verdict = self._parse_single_response(response)
+            self._cache_verdict(email, verdict)
+            return verdict
+            
+        except Exception as e:
+            logger.error("Error analyzing email: %s", e)
+            return False, "Error occurred"
+    
+    async def is_spam_async(self, email):
+        """Async version of is_spam using the AsyncOpenAI client."""
+        known_verdict = self._known_verdict(email)
+        if known_verdict is not None:
+            return known_verdict
+        return await self._classify_with_llm_async(email)
+    
+    async def _classify_with_llm_async(self, email):
+        """Async version of _classify_with_llm using the AsyncOpenAI client."""
+        try:
+            response = await self._create_completion_async(self._spam_completion_kwargs(email))
+            
+            verdict = self._parse_single_response(response)
+            self._cache_verdict(email, verdict)
+            return verdict
+            
+        except Exception as e:
+            logger.error("Error analyzing email: %s", e)
+            return False, "Error occurred"
+    
+    def is_spam_bulk(self, emails):
+        """Classify several emails with one LLM request, falling back to per-email calls."""
+        verdicts = self._lookup_verdicts(emails)
+        uncached_emails = [email for email, verdict in zip(emails, verdicts) if verdict is None]
+        if not uncached_emails:
+            return verdicts
+        return self._merge_verdicts(verdicts, self._classify_bulk_with_llm(uncached_emails))
+    
+    def _classify_bulk_with_llm(self, emails):
+        """Classify emails that have no known verdict with one LLM request, falling back to per-email calls."""
+        results = None
+        try:
+            response = self.openai_client.chat.completions.create(**self._bulk_completion_kwargs(emails))
+            self._log_prompt_cache_usage(response)
+            results = self._parse_bulk_response(response.choices[0].message.content, emails)
+        except Exception as e:
+            logger.error("Error analyzing email batch: %s", e)
+        
+        if results is None:
+            return [self._classify_with_llm(email) for email in emails]
+        for email, verdict in zip(emails, results):
+            self._cache_verdict(email, verdict)
+        return results
+    
+    async def is_spam_bulk_async(self, emails):
+        """Async version of is_spam_bulk using the AsyncOpenAI client."""
+        verdicts = await self._lookup_verdicts_async(emails)
+        uncached_emails = [email for email, verdict in zip(emails, verdicts) if verdict is None]
+        if not uncached_emails:
+            return verdicts
+        return self._merge_verdicts(verdicts, await self._classify_bulk_with_llm_async(uncached_emails))
+    
+    async def _classify_bulk_with_llm_async(self, emails):
+        """Async version of _classify_bulk_with_llm using the AsyncOpenAI client."""
+        results = None
+        try:
+            response = await self._create_completion_async(self._bulk_completion_kwargs(emails))
+            results = self._parse_bulk_response(response.choices[0].message.content, emails)
+        except Exception as e:
+            logger.error("Error analyzing email batch: %s", e)
         
+        if results is None:
+            return await asyncio.gather(*[self._classify_with_llm_async(email) for email in emails])
+        for email, verdict in zip(emails, results):
+            self._cache_verdict(email, verdict)
+        return results
+    
+    def is_spam_batch_api(self, emails, poll_interval=BATCH_API_POLL_SECONDS):
+        """Classify emails through the OpenAI Batch API, which is half price but can take up to 24h."""
+        verdicts = self._lookup_verdicts(emails)
+        uncached_emails = [email for email, verdict in zip(emails, verdicts) if verdict is None]
+        if not uncached_emails:
+            return verdicts
+        
+        chunks = [uncached_emails[i:i + SPAM_BATCH_SIZE] for i in range(0, len(uncached_emails), SPAM_BATCH_SIZE)]
+        contents = {}
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=100,
-                temperature=0.1
+            lines = [orjson.dumps({
+                'custom_id': f'chunk-{i}',
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': self._bulk_completion_kwargs(chunk),
+            }) for i, chunk in enumerate(chunks)]
+            batch_file = self.openai_client.files.create(
+                file=('spam_batch.jsonl', b'\n'.join(lines)),
+                purpose='batch'
+            )
+            batch = self.openai_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h'
             )
+            logger.info("Submitted OpenAI batch %s with %d requests", batch.id, len(lines))
             
-            result = response.choices[0].message.content.strip()
-            return result.startswith("SPAM"), result
+            while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+                time.sleep(poll_interval)
+                batch = self.openai_client.batches.retrieve(batch.id)
+                if batch.request_counts:
+                    logger.info("OpenAI batch %s is %s: %d/%d requests done", batch.id, batch.status,
+                                batch.request_counts.completed + batch.request_counts.failed,
+                                batch.request_counts.total)
+            logger.info("OpenAI batch %s finished with status %s", batch.id, batch.status)
             
+            if batch.output_file_id:
+                for line in self.openai_client.files.content(batch.output_file_id).content.splitlines():
+                    result = orjson.loads(line)
+                    response = result.get('response')
+                    if response and response.get('status_code') == 200:
+                        contents[result['custom_id']] = response['body']['choices'][0]['message']['content']
         except Exception as e:
-            print(f"Error analyzing email: {e}")
-            return False, "Error occurred"
+            logger.error("Error running OpenAI batch: %s", e)
+        
+        results = []
+        for i, chunk in enumerate(chunks):
+            chunk_results = None
+            if f'chunk-{i}' in contents:
+                chunk_results = self._parse_bulk_response(contents[f'chunk-{i}'], chunk)
+            if chunk_results is None:
+                # Requests the batch could not answer are retried live
+                chunk_results = self._classify_bulk_with_llm(chunk)
+            else:
+                for email, verdict in zip(chunk, chunk_results):
+                    self._cache_verdict(email, verdict)
+            results.extend(chunk_results)
+        
+        return self._merge_verdicts(verdicts, results)
+    
+    def _merge_verdicts(self, known_verdicts, new_verdicts):
+        """Fill the missing entries of known_verdicts, in order, from new_verdicts."""
+        new_verdicts = iter(new_verdicts)
+        return [verdict if verdict is not None else next(new_verdicts) for verdict in known_verdicts]
+    
+    def get_unsubscribe_links(self, email):
+        """Find unsubscribe links for an email, preferring its List-Unsubscribe header."""
+        # The header already names the unsubscribe URLs, so skip fetching and parsing the HTML
+        header_urls = LIST_UNSUBSCRIBE_URL_PATTERN.findall(email.get('list_unsubscribe', ''))
+        if header_urls:
+            if ONE_CLICK_UNSUBSCRIBE_PATTERN.search(email.get('list_unsubscribe_post', '')):
+                self.one_click_unsubscribe_urls.update(url for url in header_urls if url.startswith('https://'))
+            return header_urls
+        
+        if 'html_data' in email:
+            raw_html = ''.join(self._decode_base64_data(data) for data in email['html_data'])
+        else:
+            raw_html = self.get_raw_email_html(email['id'])
+        return self.find_unsubscribe_links(email['body'], raw_html)
     
     def find_unsubscribe_links(self, email_body, raw_html_body=None):
         """Find unsubscribe links in email body."""
         unsubscribe_urls = set()
         
-        # Common unsubscribe patterns
-        unsubscribe_patterns = [
-            r'https?://[^\s]+unsubscribe[^\s]*',
-            r'https?://[^\s]+opt[_-]?out[^\s]*',
-            r'https?://[^\s]+remove[^\s]*',
-            r'https?://[^\s]+stop[^\s]*'
-        ]
-        
         # Search in plain text body
-        for pattern in unsubscribe_patterns:
-            matches = re.findall(pattern, email_body, re.IGNORECASE)
-            for match in matches:
-                # Clean up common trailing characters
-                url = re.sub(r'[>)\].,;"\'\n]*$', '', match)
-                unsubscribe_urls.add(url)
+        for match in UNSUBSCRIBE_URL_PATTERN.findall(email_body):
+            # Clean up common trailing characters
+            unsubscribe_urls.add(URL_TRAILING_CHARS_PATTERN.sub('', match))
         
         # If we have raw HTML, also search there
         if raw_html_body:
             try:
-                soup = BeautifulSoup(raw_html_body, 'html.parser')
-                
-                # Look for links with unsubscribe-related text
-                for link in soup.find_all('a', href=True):
-                    href = link.get('href')
-                    text = link.get_text().lower()
-                    
-                    if any(word in text for word in ['unsubscribe', 'opt out', 'remove', 'stop']):
-                        if href.startswith('http'):
-                            unsubscribe_urls.add(href)
-                    
-                    # Also check href for unsubscribe patterns
-                    if any(word in href.lower() for word in ['unsubscribe', 'opt-out', 'optout', 'remove']):
-                        if href.startswith('http'):
-                            unsubscribe_urls.add(href)
+                # Look for http(s) links with unsubscribe-related text or href; the selector
+                # filters the scheme in the parser, and the href is checked first since
+                # link.text() has to walk the link's subtree
+                for link in LexborHTMLParser(raw_html_body).css('a[href^="http"]'):
+                    href = link.attributes.get('href') or ''
+                    if (UNSUBSCRIBE_HREF_PATTERN.search(href)
+                            or UNSUBSCRIBE_LINK_TEXT_PATTERN.search(link.text())):
+                        unsubscribe_urls.add(href)
             except Exception as e:
-                print(f"Error parsing HTML for unsubscribe links: {e}")
+                logger.error("Error parsing HTML for unsubscribe links: %s", e)
         
         return list(unsubscribe_urls)
     
     def attempt_unsubscribe(self, unsubscribe_urls):
-        """Attempt to unsubscribe using the provided URLs."""
-        success_count = 0
+        """Attempt to unsubscribe using the provided URLs, blocking until done."""
+        async def unsubscribe():
+            # asyncio.run() starts a fresh event loop, so use a client bound to it
+            async with _new_unsubscribe_client() as client:
+                return await self.attempt_unsubscribe_async(unsubscribe_urls, client)
         
-        for url in unsubscribe_urls[:3]:  # Limit to first 3 URLs to avoid spam
-            try:
-                print(f"   🔗 Attempting unsubscribe: {url[:80]}...")
-                
-                # First try a GET request
-                response = self.unsubscribe_session.get(url, timeout=10, allow_redirects=True)
+        return asyncio.run(unsubscribe())
+    
+    async def attempt_unsubscribe_async(self, unsubscribe_urls, client=None):
+        """Attempt to unsubscribe using the provided URLs, trying them concurrently."""
+        if client is None:
+            if self.unsubscribe_client is None:
+                self.unsubscribe_client = _new_unsubscribe_client()
+            client = self.unsubscribe_client
+        # Limit to first 3 URLs to avoid spam
+        results = await asyncio.gather(*[self._try_unsubscribe(client, url) for url in unsubscribe_urls[:3]])
+        return sum(results)
+    
+    async def _try_unsubscribe(self, client, url):
+        """Visit one unsubscribe URL, submitting its confirmation form if it has one; return 1 on success."""
+        try:
+            logger.info("🔗 Attempting unsubscribe: %s...", url[:80])
+            
+            # RFC 8058: a single POST unsubscribes, with no page or form to handle
+            if url in self.one_click_unsubscribe_urls:
+                response = await client.post(url, data={'List-Unsubscribe': 'One-Click'})
+                if response.is_success:
+                    logger.info("✅ One-click unsubscribe succeeded (status: %s)", response.status_code)
+                    return 1
+                logger.warning("❌ One-click unsubscribe failed (status: %s)", response.status_code)
+                return 0
+            
+            # Otherwise try a GET request
+            response = await client.get(url)
+            
+            if response.status_code != 200:
+                logger.warning("❌ Failed to access unsubscribe URL (status: %s)", response.status_code)
+                return 0
+            
+            # Look for forms or additional confirmation
+            tree = LexborHTMLParser(response.text)
+            
+            # Look for unsubscribe forms
+            for form in tree.css('form'):
+                # Check if this looks like an unsubscribe form
+                form_text = form.text().lower()
+                if not any(word in form_text for word in ['unsubscribe', 'remove', 'opt out', 'confirm']):
+                    continue
                 
-                if response.status_code == 200:
-                    # Look for forms or additional confirmation
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    
-                    # Look for unsubscribe forms
-                    forms = soup.find_all('form')
-                    form_submitted = False
+                try:
+                    action = form.attributes.get('action') or ''
+                    method = (form.attributes.get('method') or 'get').lower()
                     
-                    for form in forms:
-                        # Check if this looks like an unsubscribe form
-                        form_text = form.get_text().lower()
-                        if any(word in form_text for word in ['unsubscribe', 'remove', 'opt out', 'confirm']):
-                            try:
-                                action = form.get('action', '')
-                                method = form.get('method', 'get').lower()
-                                
-                                if action:
-                                    action_url = urljoin(url, action)
-                                else:
-                                    action_url = url
-                                
-                                # Collect form data
-                                form_data = {}
-                                for input_tag in form.find_all(['input', 'select']):
-                                    name = input_tag.get('name')
-                                    value = input_tag.get('value', '')
-                                    input_type = input_tag.get('type', '').lower()
-                                    
-                                    if name and input_type not in ['submit', 'button', 'reset']:
-                                        form_data[name] = value
-                                
-                                # Submit the form
-                                if method == 'post':
-                                    form_response = self.unsubscribe_session.post(
-                                        action_url, data=form_data, timeout=10
-                                    )
-                                else:
-                                    form_response = self.unsubscribe_session.get(
-                                        action_url, params=form_data, timeout=10
-                                    )
-                                
-                                if form_response.status_code in [200, 302]:
-                                    print(f"   ✅ Form submitted successfully")
-                                    form_submitted = True
-                                    success_count += 1
-                                    break
-                                    
-                            except Exception as e:
-                                print(f"   ⚠️  Form submission failed: {e}")
+                    if action:
+                        action_url = urljoin(url, action)
+                    else:
+                        action_url = url
                     
-                    if not form_submitted:
-                        # If no form found, the GET request itself might be sufficient
-                        print(f"   ✅ Unsubscribe request sent (status: {response.status_code})")
-                        success_count += 1
+                    # Collect form data
+                    form_data = {}
+                    for input_tag in form.css('input, select'):
+                        name = input_tag.attributes.get('name')
+                        value = input_tag.attributes.get('value') or ''
+                        input_type = (input_tag.attributes.get('type') or '').lower()
                         
-                else:
-                    print(f"   ❌ Failed to access unsubscribe URL (status: {response.status_code})")
+                        if name and input_type not in ['submit', 'button', 'reset']:
+                            form_data[name] = value
                     
-            except requests.RequestException as e:
-                print(f"   ❌ Network error accessing unsubscribe URL: {e}")
-            except Exception as e:
-                print(f"   ❌ Error processing unsubscribe URL: {e}")
-        
-        return success_count
+                    # Submit the form
+                    if method == 'post':
+                        form_response = await client.post(action_url, data=form_data)
+                    else:
+                        form_response = await client.get(action_url, params=form_data)
+                    
+                    if form_response.status_code in [200, 302]:
+                        logger.info("✅ Form submitted successfully")
+                        return 1
+                        
+                except Exception as e:
+                    logger.warning("⚠️  Form submission failed: %s", e)
+            
+            # If no form was submitted, the GET request itself might be sufficient
+            logger.info("✅ Unsubscribe request sent (status: %s)", response.status_code)
+            return 1
+            
+        except httpx.HTTPError as e:
+            logger.warning("❌ Network error accessing unsubscribe URL: %s", e)
+        except Exception as e:
+            logger.error("❌ Error processing unsubscribe URL: %s", e)
+        return 0
     
     def get_raw_email_html(self, email_id):
         """Get the raw HTML content of an email for unsubscribe link extraction."""
@@ -399,56 +1326,77 @@ class GmailSpamKiller:
             msg = self.service.users().messages().get(
                 userId='me',
                 id=email_id,
-                format='full'
+                format='full',
+                fields=GMAIL_BODY_FIELDS
             ).execute()
             
-            def extract_html_from_parts(parts):
-                """Recursively extract HTML from email parts."""
-                html_content = ""
-                
-                for part in parts:
-                    mime_type = part.get('mimeType', '')
-                    
-                    if 'parts' in part:
-                        html_content += extract_html_from_parts(part['parts'])
-                    elif mime_type == 'text/html' and 'data' in part.get('body', {}):
-                        try:
-                            decoded = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-                            html_content += decoded
-                        except Exception:
-                            pass
-                
-                return html_content
-            
-            html_body = ""
-            payload = msg['payload']
-            
-            if 'parts' in payload:
-                html_body = extract_html_from_parts(payload['parts'])
-            else:
-                if payload.get('mimeType') == 'text/html' and 'data' in payload.get('body', {}):
-                    try:
-                        html_body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='ignore')
-                    except Exception:
-                        pass
-            
-            return html_body
+            return ''.join(
+                self._decode_base64_data(data)
+                for data in self._iter_part_data(msg['payload'], 'text/html')
+            )
             
         except Exception as e:
-            print(f"Error getting raw email HTML: {e}")
+            logger.error("Error getting raw email HTML: %s", e)
             return None
     
-    def _analyze_email_batch(self, email_with_index):
-        """Analyze a single email and return result with original index."""
-        index, email = email_with_index
-        is_spam_result, reason = self.is_spam(email)
-        return index, email, is_spam_result, reason
+    async def fetch_and_classify(self, max_emails, on_batch=None):
+        """Classify each page of inbox emails while the next page is still being fetched.
+        
+        Returns (emails, duplicate_emails, classified) where duplicate_emails comes
+        from deduplicate_emails and classified holds (index, email, is_spam, reason)
+        tuples for the unique emails, in completion order.
+        
+        If given, on_batch is awaited after each batch with that batch's tuples, the
+        number of emails analyzed so far and the number of unique emails found so far.
+        """
+        emails = []
+        duplicate_emails = []
+        first_index_by_message_id = {}
+        classified = []
+        semaphore = asyncio.Semaphore(MAX_WORKERS)
+        
+        async def classify_batch(batch):
+            async with semaphore:
+                verdicts = await self.is_spam_bulk_async([email for _, email in batch])
+            batch_results = [
+                (index, email, is_spam_result, reason)
+                for (index, email), (is_spam_result, reason) in zip(batch, verdicts)
+            ]
+            classified.extend(batch_results)
+            if on_batch is not None:
+                await on_batch(batch_results, len(classified), len(emails) - len(duplicate_emails))
+        
+        tasks = []
+        pages = self.iter_recent_emails(max_emails)
+        while True:
+            # Gmail calls are blocking, so run them off the event loop
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            
+            # Only analyze the first copy of each Message-ID
+            unique_emails, duplicates = self.deduplicate_emails(enumerate(page, len(emails)), first_index_by_message_id)
+            emails.extend(page)
+            duplicate_emails.extend(duplicates)
+            await asyncio.to_thread(self.fetch_email_bodies, [email for _, email in unique_emails])
+            
+            for i in range(0, len(unique_emails), SPAM_BATCH_SIZE):
+                tasks.append(asyncio.create_task(classify_batch(unique_emails[i:i + SPAM_BATCH_SIZE])))
+        
+        # A failed batch leaves its emails unclassified rather than aborting the run
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Error processing emails: %s", result)
+        return emails, duplicate_emails, classified
             
     def _ensure_ai_archived_label(self):
         """Create or find the 'AI Archived' label."""
         try:
+            # This can run from the web app's worker threads, so use a connection of its own
+            http = self._thread_safe_http()
+            
             # Get all labels
-            labels = self.service.users().labels().list(userId='me').execute()
+            labels = self.service.users().labels().list(userId='me').execute(http=http)
             
             # Check if 'AI Archived' label exists
             for label in labels.get('labels', []):
@@ -466,19 +1414,19 @@ class GmailSpamKiller:
             created_label = self.service.users().labels().create(
                 userId='me',
                 body=label_object
-            ).execute()
+            ).execute(http=http)
             
             self.ai_archived_label_id = created_label['id']
-            print(f"Created 'AI Archived' label with ID: {self.ai_archived_label_id}")
+            logger.info("Created 'AI Archived' label with ID: %s", self.ai_archived_label_id)
             
         except Exception as e:
-            print(f"Error creating/finding AI Archived label: {e}")
+            logger.error("Error creating/finding AI Archived label: %s", e)
             self.ai_archived_label_id = None
     
     def _collect_spam_examples(self):
         """Collect examples from the user's spam folder to improve detection."""
         try:
-            print("📚 Collecting spam examples from your spam folder...")
+            logger.info("📚 Collecting spam examples from your spam folder...")
             
             # Query for spam emails
             results = self.service.users().messages().list(
@@ -489,59 +1437,58 @@ class GmailSpamKiller:
             
             messages = results.get('messages', [])
             
-            for message in messages:
+            # Get headers and snippets in a single batched round trip
+            message_ids = [message['id'] for message in messages]
+            examples = []
+            for msg in self._batch_get_messages(message_ids, format='metadata', fields=GMAIL_METADATA_FIELDS,
+                                                metadataHeaders=['Subject', 'From']):
                 try:
-                    # Get message details
-                    msg = self.service.users().messages().get(
-                        userId='me',
-                        id=message['id'],
-                        format='full'
-                    ).execute()
-                    
                     # Extract headers
-                    headers = msg['payload'].get('headers', [])
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                    sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-                    
-                    # Extract body (limited)
-                    body = self.extract_email_body(msg['payload'])
-                    
-                    self.spam_examples.append({
-                        'subject': subject[:100],  # Limit length
-                        'sender': sender[:100],
-                        'body': body[:1000]  # Limit body length
+                    headers = self._header_dict(msg['payload'])
+                    examples.append({
+                        'id': msg['id'],
+                        'subject': headers.get('subject', 'No Subject'),
+                        'sender': headers.get('from', 'Unknown Sender'),
+                        'body': html.unescape(msg.get('snippet', ''))
                     })
                     
                 except Exception as e:
-                    print(f"Error processing spam example: {e}")
+                    logger.error("Error processing spam example: %s", e)
                     continue
             
-            print(f"✅ Collected {len(self.spam_examples)} spam examples for improved detection")
+            # Like inbox emails, only fetch and parse the full body when the snippet is too short
+            self.fetch_email_bodies(examples)
+            self.spam_examples = [{
+                'subject': example['subject'][:100],  # Limit length
+                'sender': example['sender'][:100],
+                'body': example['body'][:BODY_CHAR_LIMIT]  # Limit body length
+            } for example in examples]
+            
+            logger.info("✅ Collected %d spam examples for improved detection", len(self.spam_examples))
             
         except Exception as e:
-            print(f"⚠️  Could not collect spam examples: {e}")
+            logger.warning("⚠️  Could not collect spam examples: %s", e)
             self.spam_examples = []
         
         # Build the prompt template once
         self._build_spam_detection_prompt()
 
-        # Remove debug output of prompt
-        print("The prompt is ============================")
-        print(self.spam_detection_prompt_template)
+        logger.debug("The prompt is ============================\n%s", self.spam_detection_instructions)
     
     def _build_spam_detection_prompt(self):
-        """Build the spam detection prompt template once with collected examples."""
+        """Build the spam detection instructions once with collected examples."""
         # Build spam examples section
         spam_examples_text = ""
         if self.spam_examples:
             spam_examples_text = "\n\nHere are examples of emails that were previously identified as spam:\n"
             for i, example in enumerate(self.spam_examples[:10], 1):  # Use up to 5 examples
+                fields = self._prompt_fields(example)
                 spam_examples_text += f"\nSpam Example {i}:\n"
-                spam_examples_text += f"Subject: {example['subject']}\n"
-                spam_examples_text += f"From: {example['sender']}\n"
-                spam_examples_text += f"Body: {example['body']}\n"
+                spam_examples_text += f"Subject: {fields['subject']}\n"
+                spam_examples_text += f"From: {fields['sender']}\n"
+                spam_examples_text += f"Body: {fields['body']}\n"
         
-        self.spam_detection_prompt_template = f"""
+        self.spam_detection_instructions = f"""
 You are analyzing the inbox of {USER_DESCRIPTION}.
 
 You should classify emails as either SPAM or NOT_SPAM, dependent on whether the user wants them to appear in their main inbox. 
@@ -549,36 +1496,66 @@ You should classify emails as either SPAM or NOT_SPAM, dependent on whether the
 Typically, SMAP emails include unsolicited promotional or informational content, but you should use your judgment on what a user might want to see. Keep in mind your knowedlge of the user preferences. Some examples of emails the user has classified as SPAM in the past are:
 
 {spam_examples_text}
-
-===================================================================
-Email to Analyze:
-Subject: {{subject}}
-From: {{sender}}
-Body: {{body}}
-
-Based on the above criteria and spam examples, respond with only "SPAM" or "NOT_SPAM" followed by a brief reason.
 """
+        self.spam_detection_system_message = {"role": "system", "content": self.spam_detection_instructions}
     
     def archive_email(self, email_id):
         """Archive an email by removing INBOX label and adding AI Archived label."""
+        return self.archive_emails_bulk([email_id])
+    
+    def archive_emails_bulk(self, email_ids):
+        """Archive several emails with messages.batchModify, up to 1000 per request."""
         try:
-            body = {'removeLabelIds': ['INBOX']}
-            
-            # Add AI Archived label if available
-            if self.ai_archived_label_id:
-                body['addLabelIds'] = [self.ai_archived_label_id]
-            
-            self.service.users().messages().modify(
-                userId='me',
-                id=email_id,
-                body=body
-            ).execute()
+            self._batch_modify_archive(email_ids)
             return True
         except Exception as e:
-            print(f"Error archiving email {email_id}: {e}")
+            error = e
+        
+        # A label ID from session_cache.json may be stale (label deleted, or a different account)
+        if self._refresh_ai_archived_label():
+            try:
+                self._batch_modify_archive(email_ids)
+                return True
+            except Exception as e:
+                error = e
+        
+        logger.error("Error archiving emails %s: %s", ', '.join(email_ids), error)
+        return False
+    
+    def _batch_modify_archive(self, email_ids):
+        """Remove the INBOX label from emails (adding AI Archived if available) with batchModify."""
+        body = {'removeLabelIds': ['INBOX']}
+        
+        # Add AI Archived label if available
+        if self.ai_archived_label_id:
+            body['addLabelIds'] = [self.ai_archived_label_id]
+        
+        # The web app archives from worker threads, so don't share the service's connection
+        http = self._thread_safe_http()
+        for start in range(0, len(email_ids), GMAIL_BATCH_MODIFY_SIZE):
+            self.service.users().messages().batchModify(
+                userId='me',
+                body={**body, 'ids': email_ids[start:start + GMAIL_BATCH_MODIFY_SIZE]}
+            ).execute(http=http)
+    
+    def _refresh_ai_archived_label(self):
+        """Look the 'AI Archived' label up again, returning True if the ID in use was stale."""
+        stale_label_id = self.ai_archived_label_id
+        if not stale_label_id:
             return False
+        
+        self._ensure_ai_archived_label()
+        if self.ai_archived_label_id == stale_label_id:
+            return False
+        
+        logger.warning("'AI Archived' label ID %s was stale; discarding %s", stale_label_id, SESSION_CACHE_PATH)
+        try:
+            os.remove(SESSION_CACHE_PATH)
+        except OSError:
+            pass
+        return True
             
-    def run_spam_filter(self, dry_run=True, max_emails=MAX_EMAILS):
+    def run_spam_filter(self, dry_run=True, max_emails=MAX_EMAILS, use_batch_api=False):
         """Main function to run the spam filter with parallelized analysis."""
         start_time = time.time()
         
@@ -593,65 +1570,68 @@ Based on the above criteria and spam examples, respond with only "SPAM" or "NOT_
         else:
             print("⚠️  Warning: Could not create/find 'AI Archived' label")
             
-        print(f"Fetching up to {max_emails} emails from {START_DATE} to {END_DATE}...")
-        emails = self.get_recent_emails(max_emails)
-        
-        if not emails:
-            print("No emails found.")
-            return
+        start_date, end_date = get_date_range()
+        print(f"Fetching up to {max_emails} emails from {start_date} to {end_date}...")
+        analysis_start_time = time.time()
         
-        # Filter emails to only process those in INBOX
-        inbox_emails = [(i, email) for i, email in enumerate(emails) if 'INBOX' in email['labels']]
+        if use_batch_api:
+            emails = self.get_recent_emails(max_emails)
+            # Only analyze the first copy of each Message-ID
+            unique_emails, duplicate_emails = self.deduplicate_emails(enumerate(emails))
+            self.fetch_email_bodies([email for _, email in unique_emails])
+            
+            print(f"📦 Submitting {len(unique_emails)} emails to the OpenAI Batch API (this can take a while)...")
+            verdicts = self.is_spam_batch_api([email for _, email in unique_emails])
+            classified = [
+                (index, email, is_spam_result, reason)
+                for (index, email), (is_spam_result, reason) in zip(unique_emails, verdicts)
+            ]
+        else:
+            print(f"📊 Analyzing emails as they arrive with up to {MAX_WORKERS} concurrent requests...")
+            
+            async def report_progress(batch_results, analyzed, total):
+                print(f"\r⚡ Progress: {analyzed}/{total} emails analyzed", end="", flush=True)
+            
+            emails, duplicate_emails, classified = asyncio.run(self.fetch_and_classify(max_emails, report_progress))
         
-        if not inbox_emails:
+        if not emails:
             print("No emails in inbox to process.")
             return
         
-        analysis_start_time = time.time()
-        print(f"📊 Analyzing {len(inbox_emails)} emails in parallel using {MAX_WORKERS} workers...")
-        
-        # Store results with original index to maintain order
-        results = {}
+        # Store (email, is_spam, reason) at the original index to maintain order
+        results = [None] * len(emails)
         spam_count = 0
+        for index, email, is_spam_result, reason in classified:
+            results[index] = (email, is_spam_result, reason)
+            if is_spam_result:
+                spam_count += 1
         
-        # Process emails in parallel
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Submit all analysis tasks
-            future_to_index = {executor.submit(self._analyze_email_batch, email_with_index): email_with_index[0] 
-                              for email_with_index in inbox_emails}
-            
-            # Collect results as they complete
-            completed_count = 0
-            for future in as_completed(future_to_index):
-                completed_count += 1
-                print(f"\r⚡ Progress: {completed_count}/{len(inbox_emails)} emails analyzed", end="", flush=True)
-                
-                try:
-                    index, email, is_spam_result, reason = future.result()
-                    results[index] = {
-                        'email': email,
-                        'is_spam': is_spam_result,
-                        'reason': reason
-                    }
-                    if is_spam_result:
-                        spam_count += 1
-                except Exception as e:
-                    print(f"\nError processing email: {e}")
+        # Fetch the HTML of all spam emails at once rather than one by one for unsubscribe links
+        self.fetch_email_html([result[0] for result in results if result is not None and result[1]])
+        
+        # Duplicates share the verdict of the first email with their Message-ID
+        for index, email, first_index in duplicate_emails:
+            if results[first_index] is not None:
+                first_email, is_spam_result, reason = results[first_index]
+                email['body'] = first_email['body']
+                email['html_data'] = first_email.get('html_data', [])
+                results[index] = (email, is_spam_result, reason)
+                if is_spam_result:
+                    spam_count += 1
         
         analysis_end_time = time.time()
         analysis_time = analysis_end_time - analysis_start_time
         
-        print(f"\n⚡ Analysis completed in {analysis_time:.2f} seconds")
+        print(f"\n⚡ Fetching and analysis completed in {analysis_time:.2f} seconds")
         print("=" * 60)
         print("📋 Analysis Results (in original order):")
         print("=" * 60)
         
         # Display results in original order
-        for i in sorted(results.keys()):
-            result = results[i]
-            email = result['email']
-            is_spam_result = result['is_spam']
-            reason = result['reason']
+        for result in results:
+            if result is None:
+                continue
+            email, is_spam_result, reason = result
             
             print(f"\n📧 Processing: {email['subject'][:50]}...")
             print(f"   From: {email['sender']}")
@@ -662,8 +1642,7 @@ Based on the above criteria and spam examples, respond with only "SPAM" or "NOT_
                 if dry_run:
                     print("   [DRY RUN] Would archive and label as 'AI Archived'")
                     # Still show unsubscribe links in dry run mode
-                    raw_html = self.get_raw_email_html(email['id'])
-                    unsubscribe_links = self.find_unsubscribe_links(email['body'], raw_html)
+                    unsubscribe_links = self.get_unsubscribe_links(email)
                     if unsubscribe_links:
                         print(f"   [DRY RUN] Found {len(unsubscribe_links)} unsubscribe link(s):")
                         for link in unsubscribe_links[:2]:  # Show first 2 links
@@ -671,8 +1650,7 @@ Based on the above criteria and spam examples, respond with only "SPAM" or "NOT_
                 else:
                     if input("   Archive this email? (y/N): ").lower() == 'y':
                         # First try to unsubscribe
-                        raw_html = self.get_raw_email_html(email['id'])
-                        unsubscribe_links = self.find_unsubscribe_links(email['body'], raw_html)
+                        unsubscribe_links = self.get_unsubscribe_links(email)
                         
                         if unsubscribe_links:
                             print(f"   🔍 Found {len(unsubscribe_links)} unsubscribe link(s)")
@@ -698,18 +1676,27 @@ Based on the above criteria and spam examples, respond with only "SPAM" or "NOT_
         total_time = end_time - start_time
         
         print(f"\n📊 Summary:")
-        print(f"   Processed: {len(inbox_emails)} emails")
+        print(f"   Processed: {len(emails)} emails")
         print(f"   Spam detected: {spam_count} emails")
         print(f"   Mode: {'DRY RUN' if dry_run else 'LIVE'}")
-        print(f"   Parallelization: {MAX_WORKERS} workers")
+        print(f"   Concurrency: {MAX_WORKERS} requests")
         print(f"   ⏱️  Total execution time: {total_time:.2f} seconds")
-        if len(inbox_emails) > 0:
-            print(f"   ⚡ Average time per email: {total_time/len(inbox_emails):.2f} seconds")
+        if len(emails) > 0:
+            print(f"   ⚡ Average time per email: {total_time/len(emails):.2f} seconds")
 
 def main():
     """Main entry point."""
+    parser = argparse.ArgumentParser(description="AI Gmail Spam Killer")
+    parser.add_argument('--batch', action='store_true',
+                        help="classify through the OpenAI Batch API (half price, results can take up to 24h)")
+    args = parser.parse_args()
+    
     script_start_time = time.time()
     
+    # Load environment variables
+    load_dotenv()
+    configure_logging()
+    
     if not os.getenv('OPENAI_API_KEY'):
         print("Error: OPENAI_API_KEY environment variable not set!")
         print("Please create a .env file with your OpenAI API key:")
@@ -721,7 +1708,11 @@ def main():
     # Run in dry-run mode by default for safety
     print("Running in DRY RUN mode (no emails will be archived)")
     print("To run live mode, edit the script and set dry_run=False")
-    spam_killer.run_spam_filter(dry_run=True, max_emails=MAX_EMAILS)
+    try:
+        spam_killer.run_spam_filter(dry_run=True, max_emails=MAX_EMAILS, use_batch_api=args.batch)
+    finally:
+        # Flush the verdict cache; some dbm backends only write their index on close
+        spam_killer.close()
     
     script_end_time = time.time()
     total_script_time = script_end_time - script_start_time
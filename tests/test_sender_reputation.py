@@ -0,0 +1,115 @@
+"""Sender reputation rechecks when the bulk classification request fails."""
+
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import gmail_spam_killer
+from gmail_spam_killer import (
+    GmailSpamKiller,
+    SENDER_REPUTATION_PREFIX,
+    SENDER_REPUTATION_RECHECK_INTERVAL,
+    SPAM_BATCH_SIZE,
+)
+
+BLOCKED_DOMAIN = 'spam.example'
+
+
+def spam_response():
+    """A one-token chat completion answering SPAM."""
+    top_token = SimpleNamespace(token='SPAM', logprob=-0.01)
+    choice = SimpleNamespace(logprobs=SimpleNamespace(content=[top_token]))
+    return SimpleNamespace(choices=[choice], usage=None)
+
+
+def create_completion(**kwargs):
+    """Fail bulk requests and answer single-email requests with SPAM."""
+    if 'response_format' in kwargs:
+        raise RuntimeError("bulk request failed")
+    return spam_response()
+
+
+class SenderReputationRecheckTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(gmail_spam_killer, '_verdict_tokens', return_value=('SPAM', {}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        # Skip __init__, which needs API keys and an on-disk verdict cache
+        self.spam_killer = GmailSpamKiller.__new__(GmailSpamKiller)
+        self.spam_killer.model = gmail_spam_killer.OPENAI_MODEL
+        self.spam_killer.trusted_sender_pattern = None
+        self.spam_killer.verdict_cache = {
+            SENDER_REPUTATION_PREFIX + BLOCKED_DOMAIN: {'spam': 3, 'not_spam': 0, 'last_seen': time.time()}
+        }
+        self.spam_killer.verdict_cache_lock = threading.Lock()
+        self.spam_killer.semantic_index = {}
+        self.spam_killer.spam_detection_system_message = {'role': 'system', 'content': 'instructions'}
+        self.spam_killer.openai_client = mock.Mock()
+        self.spam_killer.openai_client.embeddings.create.side_effect = RuntimeError("no embeddings")
+        self.spam_killer.openai_client.chat.completions.create.side_effect = create_completion
+        
+        self.emails = [
+            {'id': f'msg-{i}', 'sender': f'Promo <deals@{BLOCKED_DOMAIN}>', 'subject': f'Sale {i}', 'body': 'Buy now'}
+            for i in range(3 * SENDER_REPUTATION_RECHECK_INTERVAL)
+        ]
+    
+    def classify_all(self):
+        verdicts = []
+        for start in range(0, len(self.emails), SPAM_BATCH_SIZE):
+            verdicts.extend(self.spam_killer.is_spam_bulk(self.emails[start:start + SPAM_BATCH_SIZE]))
+        return verdicts
+    
+    def single_email_calls(self):
+        create = self.spam_killer.openai_client.chat.completions.create
+        return [call for call in create.call_args_list if 'response_format' not in call.kwargs]
+    
+    def reputation(self):
+        return self.spam_killer.verdict_cache[SENDER_REPUTATION_PREFIX + BLOCKED_DOMAIN]
+    
+    def test_rechecks_reach_the_llm_when_the_bulk_request_fails(self):
+        verdicts = self.classify_all()
+        
+        self.assertTrue(all(is_spam for is_spam, _ in verdicts))
+        self.assertEqual(len(self.single_email_calls()), 3)
+        self.assertEqual(self.reputation()['skipped'], len(self.emails))
+    
+    def test_async_rechecks_reach_the_llm_when_the_bulk_request_fails(self):
+        self.spam_killer.async_openai_client = mock.Mock()
+        self.spam_killer.async_openai_client.embeddings.create = mock.AsyncMock(side_effect=RuntimeError("no embeddings"))
+        
+        async def create_completion_async(completion_kwargs):
+            return create_completion(**completion_kwargs)
+        
+        self.spam_killer._create_completion_async = mock.AsyncMock(side_effect=create_completion_async)
+        
+        async def classify_all():
+            return await asyncio.gather(*[
+                self.spam_killer.is_spam_bulk_async(self.emails[start:start + SPAM_BATCH_SIZE])
+                for start in range(0, len(self.emails), SPAM_BATCH_SIZE)
+            ])
+        
+        asyncio.run(classify_all())
+        
+        single_calls = [
+            call for call in self.spam_killer._create_completion_async.call_args_list
+            if 'response_format' not in call.args[0]
+        ]
+        self.assertEqual(len(single_calls), 3)
+        self.assertEqual(self.reputation()['skipped'], len(self.emails))
+    
+    def test_rescan_reuses_message_verdicts_without_counting_them(self):
+        self.classify_all()
+        rechecked_ids = {call.kwargs['messages'][1]['content'] for call in self.single_email_calls()}
+        
+        self.classify_all()
+        
+        # Only the emails settled by reputation alone are counted again
+        self.assertEqual(self.reputation()['skipped'], 2 * len(self.emails) - len(rechecked_ids))
+
+
+if __name__ == '__main__':
+    unittest.main()